@@ -5,17 +5,27 @@ RAG, LLM 호출, 시뮬레이션 관련 기능 제공
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 import chromadb
 from sentence_transformers import SentenceTransformer
 import PyPDF2
 import pdfplumber
 import pandas as pd
+import numpy as np
 import tempfile
+import shutil
+import zipfile
 import os
+import hashlib
 import uuid
 import asyncio
+import threading
+import time
+import json
+import re
 
 # LLM 라이브러리
 try:
@@ -55,14 +65,47 @@ app.add_middleware(
 
 # 전역 객체
 chroma_client = chromadb.PersistentClient(path="./work_simulator_db")
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
 
 # 프로젝트별 컬렉션 관리
 project_collections: Dict[str, Any] = {}
 
+# 컬렉션 구성 방식
+# - per_user: 사용자×프로젝트마다 별도 컬렉션 (기존 방식, 기본값)
+# - shared: 프로젝트(또는 프로젝트 샤드)당 하나의 컬렉션, 사용자는 메타데이터 필터로 구분
+COLLECTION_LAYOUT = os.getenv("COLLECTION_LAYOUT", "per_user")
+# shared 모드에서 0보다 크면 프로젝트를 N개의 샤드 컬렉션에 나눠 저장
+COLLECTION_SHARDS = int(os.getenv("COLLECTION_SHARDS", "0"))
+
+# 프로젝트별 매뉴얼 요약 (업로드 시 생성, 프롬프트 앞부분에 공통으로 사용)
+DIGEST_DIR = "./work_simulator_db/digests"
+FILE_DIGEST_MAX_CHARS = 600  # 파일별 요약 최대 길이
+PROJECT_DIGEST_MAX_CHARS = 600  # 프로젝트 전체 요약 최대 길이 (프롬프트 접두부)
+project_digests: Dict[str, Dict[str, Any]] = {}
+# 요약 캐시/파일은 이벤트 루프와 작업 스레드(스냅샷, 일괄 평가)에서 함께 사용하므로 잠금으로 보호
+digest_lock = threading.RLock()
+
+# 벡터 스냅샷 (내보내기/가져오기)
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_BATCH_SIZE = 2000  # 컬렉션 읽기/쓰기 배치 크기
+
 # Ollama 동시 호출 제한을 위한 세마포어 (동시에 1개만 처리)
 ollama_semaphore = asyncio.Semaphore(1)
 
+# 대화별 상태 (롤링 요약 + 최근 메시지), (user_id, project_id, conversation_id) 기준
+conversation_states: Dict[tuple, Dict[str, Any]] = {}
+CONVERSATION_STATE_TTL = 6 * 60 * 60  # 마지막 사용 후 6시간 지나면 제거
+HISTORY_TOKEN_BUDGET = 600  # 프롬프트에 그대로 넣는 최근 대화의 토큰 예산
+SUMMARY_MAX_CHARS = 600  # 이전 대화 요약 최대 길이
+
+# 일괄 평가 시 공급자별 동시 호출 제한 (Ollama는 ollama_semaphore로 별도 제한)
+BATCH_PROVIDER_CONCURRENCY = {"openai": 8, "gemini": 8, "claude": 4, "perplexity": 4, "ollama": 1}
+batch_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+# 백그라운드 작업 참조 유지 (GC로 인한 작업 유실 방지)
+background_tasks: set = set()
+
 
 # ========================
 # Pydantic 모델 정의
@@ -118,6 +161,30 @@ class SearchRequest(BaseModel):
     user_id: Optional[str] = None  # 회원 ID (로그인 시)
 
 
+class BatchEvaluationItem(BaseModel):
+    project_id: str
+    transcript: List[Dict[str, str]]  # [{"role": "user" | "assistant", "content": "..."}]
+    role: str = "employee"  # 사용자 역할 'customer' | 'employee' (평가 대상은 보통 직원 역할 교육생)
+    item_id: Optional[str] = None  # 결과 매칭용 ID (없으면 요청 내 순번)
+    user_id: Optional[str] = None  # 회원 ID (로그인 시)
+    guidelines: Optional[str] = None  # 프로젝트 지침
+
+
+class BatchEvaluationRequest(BaseModel):
+    items: List[BatchEvaluationItem]
+    model_id: str = "gpt-4o"
+    api_keys: Optional[Dict[str, str]] = None
+
+
+class MultiSearchRequest(BaseModel):
+    queries: List[str]
+    project_id: str
+    top_k: int = 3
+    offset: int = 0  # 페이지네이션: 건너뛸 결과 수
+    where: Optional[Dict[str, Any]] = None  # 메타데이터 필터 (예: {"file_id": "..."})
+    user_id: Optional[str] = None  # 회원 ID (로그인 시)
+
+
 class LLMConfigRequest(BaseModel):
     provider: str  # ollama, openai, gemini, claude, perplexity
     model: str
@@ -227,27 +294,126 @@ def chunk_text(text: str, chunk_size: int = 300, overlap: int = 150) -> List[str
     return chunks
 
 
-def get_or_create_collection(project_id: str, user_id: Optional[str] = None):
-    """사용자 및 프로젝트별 ChromaDB 컬렉션 가져오기 또는 생성"""
+def scope_key(value: Optional[str]) -> str:
+    """컬렉션 이름/메타데이터에 사용하는 ID 형식 (비회원은 빈 문자열)"""
+    return value.replace('-', '_') if value else ""
+
+
+def legacy_collection_name(project_id: str, user_id: Optional[str] = None) -> str:
+    """per_user 방식의 컬렉션 이름"""
     # user_id가 있으면 사용자별 컬렉션, 없으면 기존 방식
     if user_id:
-        collection_name = f"user_{user_id.replace('-', '_')}_project_{project_id.replace('-', '_')}"
+        collection_name = f"user_{scope_key(user_id)}_project_{scope_key(project_id)}"
     else:
-        collection_name = f"project_{project_id.replace('-', '_')}"
+        collection_name = f"project_{scope_key(project_id)}"
     
     # 컬렉션 이름 길이 제한 (ChromaDB는 63자 제한)
     if len(collection_name) > 63:
-        import hashlib
         hash_suffix = hashlib.md5(collection_name.encode()).hexdigest()[:8]
         collection_name = collection_name[:54] + "_" + hash_suffix
-    
+    return collection_name
+
+
+def shared_collection_name(project_id: str) -> str:
+    """shared 방식의 컬렉션 이름 (프로젝트 단위 또는 샤드 단위)"""
+    if COLLECTION_SHARDS > 0:
+        shard = int(hashlib.md5(scope_key(project_id).encode()).hexdigest(), 16) % COLLECTION_SHARDS
+        return f"shared_shard_{shard:03d}"
+    collection_name = f"shared_project_{scope_key(project_id)}"
+    if len(collection_name) > 63:
+        hash_suffix = hashlib.md5(collection_name.encode()).hexdigest()[:8]
+        collection_name = collection_name[:54] + "_" + hash_suffix
+    return collection_name
+
+
+class ScopedCollection:
+    """공유 컬렉션을 프로젝트/사용자 범위로 제한해 일반 컬렉션처럼 사용하는 래퍼
+
+    add/upsert 시 범위 메타데이터를 붙이고, get/query/count/delete 시 범위 필터를 적용합니다.
+    """
+
+    def __init__(self, collection, project_id: str, user_id: Optional[str] = None):
+        self.collection = collection
+        self.scope = {"project_id": scope_key(project_id), "user_id": scope_key(user_id)}
+
+    @property
+    def name(self) -> str:
+        return self.collection.name
+
+    def _where(self, where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        conditions = [{key: {"$eq": value}} for key, value in self.scope.items()]
+        if where:
+            conditions.append(where)
+        return {"$and": conditions}
+
+    def _metadatas(self, ids: List[str], metadatas: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        metadatas = metadatas or [{} for _ in ids]
+        return [{**(metadata or {}), **self.scope} for metadata in metadatas]
+
+    def add(self, ids: List[str], metadatas: Optional[List[Dict[str, Any]]] = None, **kwargs):
+        return self.collection.add(ids=ids, metadatas=self._metadatas(ids, metadatas), **kwargs)
+
+    def upsert(self, ids: List[str], metadatas: Optional[List[Dict[str, Any]]] = None, **kwargs):
+        return self.collection.upsert(ids=ids, metadatas=self._metadatas(ids, metadatas), **kwargs)
+
+    def get(self, where: Optional[Dict[str, Any]] = None, **kwargs):
+        return self.collection.get(where=self._where(where), **kwargs)
+
+    def query(self, where: Optional[Dict[str, Any]] = None, **kwargs):
+        return self.collection.query(where=self._where(where), **kwargs)
+
+    def count(self) -> int:
+        # 범위 내 ID를 모두 읽으므로 비용이 큼 - 검색 전 확인에는 query_collection 사용
+        return len(self.collection.get(where=self._where(), include=[])["ids"])
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None):
+        return self.collection.delete(ids=ids, where=self._where(where))
+
+
+def query_collection(collection, query_embeddings: List[List[float]], n_results: int, **kwargs) -> Dict[str, Any]:
+    """최대 n_results개 검색 (문서가 없으면 빈 결과)
+
+    일반 컬렉션은 count()로 n_results를 맞추고, 공유 컬렉션은 전체 개수 조회 없이 바로 검색합니다.
+    """
+    if not isinstance(collection, ScopedCollection):
+        doc_count = collection.count()
+        if doc_count == 0:
+            return {key: [[] for _ in query_embeddings] for key in ("ids", "documents", "metadatas", "distances")}
+        n_results = min(n_results, doc_count)
+    return collection.query(query_embeddings=query_embeddings, n_results=n_results, **kwargs)
+
+
+def get_or_create_collection(project_id: str, user_id: Optional[str] = None):
+    """사용자 및 프로젝트별 ChromaDB 컬렉션 가져오기 또는 생성"""
+    if COLLECTION_LAYOUT == "shared":
+        collection_name = shared_collection_name(project_id)
+        collection = project_collections.get(collection_name)
+        if collection is None:
+            collection = chroma_client.get_or_create_collection(name=collection_name)
+            project_collections[collection_name] = collection
+        return ScopedCollection(collection, project_id, user_id)
+
+    collection_name = legacy_collection_name(project_id, user_id)
+    # 해시로 축약된 이름에서도 ID를 알 수 있도록 원래 ID를 컬렉션 메타데이터에 기록
+    owner_metadata = {"project_id": project_id, "user_id": user_id or ""}
     try:
         collection = chroma_client.get_collection(name=collection_name)
     except:
-        collection = chroma_client.create_collection(name=collection_name)
+        collection = chroma_client.create_collection(name=collection_name, metadata=owner_metadata)
+    if not collection.metadata:
+        # 메타데이터 없이 만들어진 이전 컬렉션은 사용 시점에 기록
+        try:
+            collection.modify(metadata=owner_metadata)
+        except Exception as e:
+            print(f"[COLLECTION] Metadata update error: {e}")
     return collection
 
 
+def manual_excerpt(documents: List[str], manual_prefix: str, max_chars: int, max_docs: int = 2) -> str:
+    """상위 검색 결과 발췌 (요약 접두부와 합쳐 max_chars를 넘지 않도록)"""
+    return "\n\n".join(documents[:max_docs])[:max(0, max_chars - len(manual_prefix))]
+
+
 async def call_llm(prompt: str, config: LLMConfigRequest) -> str:
     """LLM 호출 통합 함수 (비동기)"""
     provider = config.provider.lower()
@@ -283,7 +449,9 @@ async def call_llm(prompt: str, config: LLMConfigRequest) -> str:
             raise HTTPException(status_code=400, detail="OpenAI API 키가 필요합니다")
         try:
             client = OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
+            # 동기 클라이언트는 별도 스레드에서 실행 (이벤트 루프 블로킹 방지)
+            response = await asyncio.to_thread(
+                client.chat.completions.create,
                 model=model,
                 messages=[{"role": "user", "content": prompt}]
             )
@@ -302,7 +470,7 @@ async def call_llm(prompt: str, config: LLMConfigRequest) -> str:
             import google.generativeai as genai_client
             genai_client.configure(api_key=api_key)
             gemini_model = genai_client.GenerativeModel(model)
-            response = gemini_model.generate_content(prompt)
+            response = await asyncio.to_thread(gemini_model.generate_content, prompt)
             return getattr(response, "text", "").strip()
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Gemini 호출 오류: {str(e)}")
@@ -315,7 +483,8 @@ async def call_llm(prompt: str, config: LLMConfigRequest) -> str:
             raise HTTPException(status_code=400, detail="Claude API 키가 필요합니다")
         try:
             client = anthropic.Anthropic(api_key=api_key)
-            message = client.messages.create(
+            message = await asyncio.to_thread(
+                client.messages.create,
                 model=model,
                 max_tokens=1024,
                 messages=[{"role": "user", "content": prompt}]
@@ -332,7 +501,8 @@ async def call_llm(prompt: str, config: LLMConfigRequest) -> str:
             raise HTTPException(status_code=400, detail="Perplexity API 키가 필요합니다")
         try:
             client = OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
-            response = client.chat.completions.create(
+            response = await asyncio.to_thread(
+                client.chat.completions.create,
                 model=model,
                 messages=[{"role": "user", "content": prompt}]
             )
@@ -389,6 +559,396 @@ def get_llm_config_from_model_id(model_id: str, api_keys: Optional[Dict[str, str
         )
 
 
+EVALUATION_CRITERIA = {"accuracy": "정확성", "kindness": "친절성", "appropriateness": "적절성"}
+
+
+def parse_score(value: str) -> float:
+    """점수 문자열을 숫자로 (정수면 int 유지)"""
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def find_labeled_score(eval_content: str, label: str, max_score: int) -> Tuple[Optional[float], bool]:
+    """label이 있는 줄에서 점수 추출, (점수, 만점이 명시된 형식인지) 반환
+
+    "X/max"와 "max점 만점에 X점"을 우선하고, 없으면 콜론 뒤 첫 숫자나 "X점"을 사용합니다.
+    """
+    for line in eval_content.splitlines():
+        if label not in line:
+            continue
+        line = line[line.index(label) + len(label):]
+        match = (
+            re.search(rf"(\d+(?:\.\d+)?)\s*/\s*{max_score}(?![\d.])", line)
+            or re.search(r"만점\s*(?:에|중|기준)?\W*?(\d+(?:\.\d+)?)\s*점?", line)
+        )
+        explicit = match is not None
+        match = match or (
+            re.search(r"[:：]\W*?(\d+(?:\.\d+)?)", line)
+            or re.match(r"\W*?(\d+(?:\.\d+)?)\s*점", line)
+        )
+        if match:
+            value = parse_score(match.group(1))
+            if 0 <= value <= max_score:
+                return value, explicit
+    return None, False
+
+
+def parse_evaluation_scores(eval_content: str) -> Dict[str, Optional[float]]:
+    """평가 결과에서 항목별 점수와 총점 추출
+
+    "**총점:** 13/15", "총점 (15점 만점): 12", "정확성: 5점 만점에 4점", "정확성: 4.5/5" 같은 변형도 허용합니다.
+    세 항목이 모두 추출되면 총점이 없을 때 항목 합계를 사용하고, 명시적인 "X/15" 총점은
+    세 항목 모두 만점이 명시된 형식일 때만 합계로 대체합니다. 추출 실패 시 None.
+    """
+    scores: Dict[str, Optional[float]] = {}
+    criteria_explicit = True
+    for key, label in EVALUATION_CRITERIA.items():
+        scores[key], explicit = find_labeled_score(eval_content, label, 5)
+        criteria_explicit = criteria_explicit and explicit
+
+    total, total_explicit = find_labeled_score(eval_content, "총점", 15)
+    parts = [scores[key] for key in EVALUATION_CRITERIA]
+    if all(part is not None for part in parts):
+        parts_sum = parse_score(str(sum(parts)))
+        if total is None or (abs(total - parts_sum) > 0.01 and (criteria_explicit or not total_explicit)):
+            total = parts_sum
+    scores["total"] = total
+    return scores
+
+
+# ========================
+# 대화 상태 (롤링 요약)
+# ========================
+
+def estimate_tokens(text: str) -> int:
+    """토큰 수 대략 추정 (한국어 기준 약 2자당 1토큰)"""
+    return len(text) // 2 + 1
+
+
+def format_history_lines(messages: List[Dict[str, str]], role: str = "customer") -> List[str]:
+    """대화 메시지를 프롬프트용 텍스트 줄로 변환
+
+    메시지의 "user"는 항상 사용자(교육생)이므로, role이 'employee'면 사용자가 직원입니다.
+    """
+    user_label, ai_label = ("직원", "고객") if role == "employee" else ("고객", "직원")
+    lines = []
+    for msg in messages:
+        role_label = user_label if msg.get("role") == "user" else ai_label
+        lines.append(f"{role_label}: {msg.get('content', '')}")
+    return lines
+
+
+def new_conversation_state(role: str = "customer") -> Dict[str, Any]:
+    return {
+        "role": role,  # 사용자 역할 ('customer' | 'employee'), 화자 표시 기준
+        "summary": "",  # 오래된 대화의 롤링 요약
+        "summarized_count": 0,  # 요약에 반영된 메시지 수
+        "messages": [],  # 아직 요약되지 않은 메시지
+        "last_content": None,  # 마지막으로 받은 메시지 내용 (히스토리 변경 감지용)
+        "summarizing": False,
+        "last_access": time.time(),
+    }
+
+
+def evict_expired_conversation_states():
+    """TTL이 지난 대화 상태 제거"""
+    now = time.time()
+    expired = [
+        key for key, state in conversation_states.items()
+        if now - state["last_access"] > CONVERSATION_STATE_TTL
+    ]
+    for key in expired:
+        del conversation_states[key]
+
+
+def history_matches_state(state: Dict[str, Any], history: List[Dict[str, str]]) -> bool:
+    """전달받은 히스토리가 상태가 알고 있는 대화의 연장인지 확인
+
+    길이와 함께 요약되지 않은 메시지 및 마지막 메시지 내용을 비교해
+    메시지 수정/재생성을 감지합니다.
+    """
+    summarized_count = state["summarized_count"]
+    known_count = summarized_count + len(state["messages"])
+    if len(history) < known_count:
+        return False
+    def pairs(messages):
+        return [(msg.get("role"), msg.get("content")) for msg in messages]
+
+    if pairs(history[summarized_count:known_count]) != pairs(state["messages"]):
+        return False
+    if known_count and history[known_count - 1].get("content") != state["last_content"]:
+        return False
+    return True
+
+
+def get_conversation_state(
+    conversation_key: tuple,
+    role: str,
+    history: Optional[List[Dict[str, str]]] = None
+) -> Dict[str, Any]:
+    """대화 상태 조회 후 전달받은 히스토리와 동기화
+
+    conversation_key는 (user_id, project_id, conversation_id)입니다.
+    history가 주어지면 이를 기준으로 새 메시지만 덧붙이고,
+    알고 있는 대화와 맞지 않으면(대화 초기화, 메시지 수정 등) 상태를 새로 만듭니다.
+    """
+    evict_expired_conversation_states()
+    state = conversation_states.get(conversation_key)
+    if state is None or state["role"] != role:
+        state = conversation_states[conversation_key] = new_conversation_state(role)
+
+    if history is not None:
+        if not history_matches_state(state, history):
+            # 진행 중인 요약 작업은 이전 상태 객체에만 반영되므로 안전
+            state = conversation_states[conversation_key] = new_conversation_state(role)
+        known_count = state["summarized_count"] + len(state["messages"])
+        state["messages"].extend(history[known_count:])
+        if history:
+            state["last_content"] = history[-1].get("content")
+
+    state["last_access"] = time.time()
+    return state
+
+
+def split_recent_messages(state: Dict[str, Any]) -> int:
+    """토큰 예산 안에 들어가는 최근 메시지의 시작 인덱스 반환 (최소 1개는 포함)"""
+    messages = state["messages"]
+    used = 0
+    start = len(messages)
+    while start > 0:
+        tokens = estimate_tokens(messages[start - 1].get("content", ""))
+        if used + tokens > HISTORY_TOKEN_BUDGET and start < len(messages):
+            break
+        used += tokens
+        start -= 1
+    return start
+
+
+def build_history_text(state: Dict[str, Any]) -> str:
+    """요약 + 최근 대화로 프롬프트용 히스토리 텍스트 생성 (길이가 대화 길이와 무관하게 일정)"""
+    sections = []
+    if state["summary"]:
+        sections.append(f"\n\n[이전 대화 요약]\n{state['summary']}")
+    recent = state["messages"][split_recent_messages(state):]
+    if recent:
+        sections.append("\n\n[이전 대화 내용]\n" + "\n".join(format_history_lines(recent, state["role"])))
+    return "".join(sections)
+
+
+async def refresh_conversation_summary(state: Dict[str, Any], config: LLMConfigRequest):
+    """최근 대화 예산을 벗어난 메시지를 요약에 반영 (응답 후 백그라운드 실행)"""
+    if state["summarizing"]:
+        return
+    split = split_recent_messages(state)
+    if split == 0:
+        return
+
+    state["summarizing"] = True
+    try:
+        old_messages = state["messages"][:split]
+        prompt = f"""다음은 고객과 직원의 상담 대화입니다. 기존 요약과 새 대화를 합쳐 요약을 갱신하세요.
+고객의 문의 내용, 직원이 안내한 핵심 정보, 아직 해결되지 않은 사항을 빠짐없이 포함하세요.
+
+[기존 요약]
+{state['summary'] or '(없음)'}
+
+[새 대화]
+{chr(10).join(format_history_lines(old_messages, state['role']))}
+
+갱신된 요약 ({SUMMARY_MAX_CHARS}자 이내):"""
+
+        summary = await call_llm(prompt, config)
+        state["summary"] = summary[:SUMMARY_MAX_CHARS]
+        state["summarized_count"] += len(old_messages)
+        # 요약하는 동안 뒤에 추가된 메시지는 그대로 유지
+        del state["messages"][:len(old_messages)]
+    except Exception as e:
+        print(f"[SUMMARY] Error: {e}")
+    finally:
+        state["summarizing"] = False
+
+
+def finish_conversation_turn(
+    state: Dict[str, Any],
+    request: ChatRequest,
+    response: str,
+    config: LLMConfigRequest
+):
+    """이번 턴을 상태에 기록하고 요약 갱신을 예약
+
+    히스토리를 보내지 않는 클라이언트를 위해 서버가 직접 메시지를 누적합니다.
+    히스토리를 보내는 경우 다음 요청에서 동기화되므로 누적하지 않습니다.
+    클라이언트와 같이 사용자 메시지는 "user", AI 메시지는 "assistant"로 저장합니다.
+    """
+    if request.conversation_history is None:
+        state["messages"].append({"role": "user", "content": request.message})
+        state["messages"].append({"role": "assistant", "content": response})
+        state["last_content"] = response
+    task = asyncio.create_task(refresh_conversation_summary(state, config))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+# ========================
+# 매뉴얼 요약 (Digest)
+# ========================
+
+def digest_path(project_id: str, user_id: Optional[str] = None) -> str:
+    """요약 파일 경로 (프로젝트별 폴더, 사용자별 파일)"""
+    project_dir = re.sub(r"[^A-Za-z0-9_]", "_", scope_key(project_id))
+    user_file = re.sub(r"[^A-Za-z0-9_]", "_", scope_key(user_id)) or "_"
+    return os.path.join(DIGEST_DIR, project_dir, f"{user_file}.json")
+
+
+def load_project_digest(project_id: str, user_id: Optional[str] = None) -> Dict[str, Any]:
+    """프로젝트 요약 조회 (메모리 캐시 → 파일, 읽을 수 없으면 빈 요약)"""
+    with digest_lock:
+        path = digest_path(project_id, user_id)
+        if path not in project_digests:
+            digest = {"files": {}, "digest": ""}
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                if isinstance(loaded, dict) and isinstance(loaded.get("files"), dict):
+                    digest = loaded
+                else:
+                    print(f"[DIGEST] Invalid digest file ignored: {path}")
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"[DIGEST] Unreadable digest file ignored: {path} ({e})")
+            project_digests[path] = digest
+        return project_digests[path]
+
+
+def save_project_digest(project_id: str, user_id: Optional[str], digest: Dict[str, Any]):
+    """파일별 요약을 합쳐 프로젝트 요약을 갱신하고 저장"""
+    with digest_lock:
+        files = sorted(digest["files"].values(), key=lambda entry: entry["created_at"])
+        # 파일 수에 맞춰 예산을 나눠 모든 파일이 요약에 포함되도록 함
+        share = PROJECT_DIGEST_MAX_CHARS // len(files) if files else 0
+        sections = []
+        for entry in files:
+            header = f"[{entry['file_name']}]\n"
+            sections.append(header + entry['digest'][:max(0, share - len(header) - 2)])
+        digest["digest"] = "\n\n".join(sections)
+
+        path = digest_path(project_id, user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 임시 파일에 쓴 뒤 교체 (쓰는 도중 중단되어도 기존 파일 유지)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(digest, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        project_digests[path] = digest
+
+
+KEY_FACT_PATTERN = re.compile(r"\d|반드시|필수|불가|가능|금지|이내|까지|기한|환불|교환|취소|주의")
+
+
+def split_sentences(text: str) -> List[str]:
+    """문장/항목 단위로 분리 (목록 기호와 번호 제거)"""
+    sentences = []
+    for line in text.splitlines():
+        for sentence in re.split(r"(?<=[.!?。])\s+", line.strip()):
+            sentence = re.sub(r"^(#+|\d+[.)]|[-*•·■□▶●◆])\s*", "", sentence.strip()).strip()
+            if 8 <= len(sentence) <= 120:
+                sentences.append(sentence)
+    return sentences
+
+
+def extract_key_facts(text: str, max_facts: int = 12) -> List[str]:
+    """LLM 없이 핵심 정보 추출 (문서 순서 유지)
+
+    숫자(가격, 기간, 연락처 등)나 규정 표현이 있는 문장을 문서 전체에서 고르게 고르고, 부족하면
+    임베딩 중심에 가까운 대표 문장으로 채웁니다.
+    """
+    sentences = list(dict.fromkeys(split_sentences(text)))
+    matched = [i for i, sentence in enumerate(sentences) if KEY_FACT_PATTERN.search(sentence)]
+    # 앞부분에 몰리지 않도록 문서 전체에서 고르게 선택
+    step = max(1, len(matched) / max_facts)
+    picked = list(dict.fromkeys(matched[int(k * step)] for k in range(min(max_facts, len(matched)))))
+
+    if len(picked) < max_facts // 2 and sentences:
+        candidates = sentences[:300]
+        vectors = embedding_model.encode(candidates, normalize_embeddings=True)
+        centrality = vectors @ vectors.mean(axis=0)
+        for i in np.argsort(-centrality):
+            if len(picked) >= max_facts // 2:
+                break
+            if int(i) not in picked:
+                picked.append(int(i))
+
+    return [sentences[i] for i in sorted(picked)]
+
+
+def build_extractive_digest(text: str) -> str:
+    """LLM 없이 만드는 요약 (제목/번호 줄로 주제 목차 + 핵심 정보 문장)"""
+    lines = [line.strip() for line in text.splitlines() if line.strip() and len(line.strip()) <= 40]
+    # 마크다운 제목이 있으면 제목만, 없으면 번호/기호로 시작하는 줄 사용
+    headings = [line.lstrip("# ").strip() for line in lines if re.match(r"^#+\s", line)]
+    if not headings:
+        headings = [line for line in lines if re.match(r"^(\d+[.)]\s|제\s*\d+|[■□▶●◆\[])", line)]
+
+    sections = []
+    if headings:
+        # 핵심 정보 자리를 남기도록 목차는 예산의 40%까지만 사용
+        sections.append(("주제 목차: " + " / ".join(headings))[:FILE_DIGEST_MAX_CHARS * 2 // 5])
+    facts = extract_key_facts(text)
+    if facts:
+        sections.append("핵심 정보: " + " / ".join(facts))
+    return "\n".join(sections)[:FILE_DIGEST_MAX_CHARS]
+
+
+def update_file_digest(
+    project_id: str,
+    user_id: Optional[str],
+    file_id: str,
+    file_name: str,
+    file_digest: str
+):
+    """파일 1개의 요약만 교체 (다른 파일 요약은 재사용)"""
+    with digest_lock:
+        digest = load_project_digest(project_id, user_id)
+        previous = digest["files"].get(file_id)
+        digest["files"][file_id] = {
+            "file_name": file_name,
+            "digest": file_digest[:FILE_DIGEST_MAX_CHARS],
+            # 순서가 바뀌면 프롬프트 접두부가 달라지므로 최초 업로드 시각 유지
+            "created_at": previous["created_at"] if previous else time.time()
+        }
+        save_project_digest(project_id, user_id, digest)
+
+
+def remove_file_digest(project_id: str, user_id: Optional[str], file_id: str):
+    with digest_lock:
+        digest = load_project_digest(project_id, user_id)
+        if digest["files"].pop(file_id, None) is not None:
+            save_project_digest(project_id, user_id, digest)
+
+
+def delete_project_digest_file(path: str):
+    """요약 파일과 캐시 삭제"""
+    with digest_lock:
+        project_digests.pop(path, None)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def get_project_digest_text(project_id: str, user_id: Optional[str] = None) -> str:
+    """프롬프트에 넣을 프로젝트 요약 (회원 요약이 없으면 비회원 요약 사용)"""
+    for owner in ([user_id, None] if user_id else [None]):
+        digest_text = load_project_digest(project_id, owner).get("digest", "")
+        if digest_text:
+            return digest_text
+    return ""
+
+
+def digest_prefix(manual_digest: str) -> str:
+    """프롬프트 맨 앞에 두는 매뉴얼 요약 (호출마다 동일 → 공급자 프롬프트 캐싱)"""
+    return f"[매뉴얼 요약]\n{manual_digest}\n\n" if manual_digest else ""
+
+
 # ========================
 # RAG 관련 엔드포인트
 # ========================
@@ -453,9 +1013,12 @@ async def upload_file(
             embeddings=[embedding],
             documents=[chunk],
             ids=[f"{file_id}_chunk_{i}"],
-            metadatas=[{"file_name": file.filename, "file_id": file_id}]
+            metadatas=[{"file_name": file.filename, "file_id": file_id, "chunk_index": i}]
         )
 
+    # 매뉴얼 요약 (이 파일 항목만 갱신)
+    update_file_digest(project_id, user_id, file_id, file.filename, build_extractive_digest(text))
+
     return FileUploadResponse(
         success=True,
         file_id=file_id,
@@ -482,17 +1045,330 @@ async def search_knowledge(request: SearchRequest):
         raise HTTPException(status_code=500, detail=f"검색 오류: {str(e)}")
 
 
+def format_search_hits(results: Dict[str, Any], query_index: int, offset: int) -> List[Dict[str, Any]]:
+    """collection.query 결과를 질의별 검색 결과 목록으로 변환"""
+    ids = (results.get('ids') or [[]])[query_index][offset:]
+    documents = (results.get('documents') or [[]])[query_index][offset:]
+    metadatas = (results.get('metadatas') or [[]])[query_index][offset:]
+    distances = (results.get('distances') or [[]])[query_index][offset:]
+
+    hits = []
+    for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances):
+        metadata = metadata or {}
+        chunk_index = metadata.get("chunk_index")
+        if chunk_index is None and "_chunk_" in chunk_id:
+            # chunk_index 메타데이터가 없는 이전 데이터는 ID에서 추출
+            suffix = chunk_id.rsplit("_chunk_", 1)[1]
+            chunk_index = int(suffix) if suffix.isdigit() else None
+        hits.append({
+            "id": chunk_id,
+            "document": document,
+            "file_name": metadata.get("file_name"),
+            "file_id": metadata.get("file_id"),
+            "chunk_index": chunk_index,
+            "distance": distance,
+            # 정규화된 임베딩의 L2 제곱 거리 -> 코사인 유사도
+            "score": 1 - distance / 2
+        })
+    return hits
+
+
+@app.post("/api/ai/search/batch")
+async def search_knowledge_batch(request: MultiSearchRequest):
+    """여러 질의를 한 번에 RAG 검색 (점수, 메타데이터 포함)"""
+    if request.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k는 1 이상이어야 합니다")
+    if request.offset < 0:
+        raise HTTPException(status_code=400, detail="offset은 0 이상이어야 합니다")
+    if not request.queries:
+        return {"results": []}
+    try:
+        collection = get_or_create_collection(request.project_id, request.user_id)
+
+        # 질의 전체를 한 번에 임베딩하고 한 번의 query로 검색
+        query_embeddings = embedding_model.encode(request.queries).tolist()
+        query_kwargs: Dict[str, Any] = {"include": ["documents", "metadatas", "distances"]}
+        if request.where:
+            query_kwargs["where"] = request.where
+        try:
+            results = query_collection(
+                collection, query_embeddings, request.offset + request.top_k, **query_kwargs
+            )
+        except ValueError as e:
+            # ChromaDB는 잘못된 where 필터를 ValueError로 알림
+            if request.where:
+                raise HTTPException(status_code=400, detail=f"잘못된 where 필터: {str(e)}")
+            raise
+
+        return {
+            "results": [
+                {"query": query, "hits": format_search_hits(results, i, request.offset)}
+                for i, query in enumerate(request.queries)
+            ],
+            "top_k": request.top_k,
+            "offset": request.offset
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"검색 오류: {str(e)}")
+
+
+@app.delete("/api/ai/project/{project_id}/files/{file_id}")
+async def delete_project_file(project_id: str, file_id: str, user_id: Optional[str] = None):
+    """프로젝트의 파일 1개(임베딩, 요약) 삭제"""
+    try:
+        collection = get_or_create_collection(project_id, user_id)
+        collection.delete(where={"file_id": file_id})
+        remove_file_digest(project_id, user_id, file_id)
+        return {"success": True, "message": "파일 삭제 완료"}
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+
 @app.delete("/api/ai/project/{project_id}/files")
 async def delete_project_files(project_id: str):
     """프로젝트의 모든 파일(임베딩) 삭제"""
     try:
-        collection_name = f"project_{project_id.replace('-', '_')}"
-        chroma_client.delete_collection(name=collection_name)
+        if COLLECTION_LAYOUT == "shared":
+            # 공유 컬렉션에서는 프로젝트 범위의 문서만 삭제 (모든 사용자)
+            collection = chroma_client.get_or_create_collection(name=shared_collection_name(project_id))
+            collection.delete(where={"project_id": scope_key(project_id)})
+            digest_dir = os.path.dirname(digest_path(project_id))
+            digest_files = [os.path.join(digest_dir, name) for name in os.listdir(digest_dir)] if os.path.isdir(digest_dir) else []
+        else:
+            chroma_client.delete_collection(name=legacy_collection_name(project_id))
+            digest_files = [digest_path(project_id)]
+        for path in digest_files:
+            delete_project_digest_file(path)
         return {"success": True, "message": "프로젝트 파일 삭제 완료"}
     except Exception as e:
         return {"success": False, "message": str(e)}
 
 
+# ========================
+# 벡터 스냅샷 (내보내기/가져오기)
+# ========================
+# 스냅샷 형식 (zip, 무압축 저장):
+#   manifest.json   - 형식 버전, 임베딩 모델, 차원, 청크 수, 매뉴얼 요약
+#   records.jsonl   - 청크별 id, document, metadata (embeddings.npy와 같은 순서)
+#   embeddings.npy  - float32 (청크 수 × 차원), 압축을 풀면 np.load(mmap_mode='r')로 바로 사용
+
+def export_collection_snapshot(project_id: str, user_id: Optional[str], snapshot_path: str, work_dir: str) -> int:
+    """컬렉션을 스냅샷 파일로 저장, 내보낸 청크 수 반환"""
+    collection = get_or_create_collection(project_id, user_id)
+    total = collection.count()
+    embeddings_path = os.path.join(work_dir, "embeddings.npy")
+    records_path = os.path.join(work_dir, "records.jsonl")
+
+    embeddings = None
+    exported = 0
+    with open(records_path, 'w', encoding='utf-8') as records_file:
+        while exported < total:
+            batch = collection.get(
+                limit=SNAPSHOT_BATCH_SIZE,
+                offset=exported,
+                include=["documents", "metadatas", "embeddings"]
+            )
+            if not batch["ids"]:
+                break
+            batch_embeddings = np.asarray(batch["embeddings"], dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    embeddings_path, mode='w+', dtype=np.float32, shape=(total, batch_embeddings.shape[1])
+                )
+            embeddings[exported:exported + len(batch["ids"])] = batch_embeddings
+            for chunk_id, document, metadata in zip(batch["ids"], batch["documents"], batch["metadatas"]):
+                # 공유 컬렉션의 범위 메타데이터는 가져올 때 다시 붙이므로 제외
+                metadata = {k: v for k, v in (metadata or {}).items() if k not in ("project_id", "user_id")}
+                records_file.write(json.dumps(
+                    {"id": chunk_id, "document": document, "metadata": metadata}, ensure_ascii=False
+                ) + "\n")
+            exported += len(batch["ids"])
+
+    if embeddings is None:
+        # 빈 파일은 memmap으로 만들 수 없으므로 일반 배열로 저장
+        np.save(embeddings_path, np.zeros((0, 0), dtype=np.float32))
+        dimension = 0
+    else:
+        dimension = embeddings.shape[1]
+        embeddings.flush()
+        del embeddings
+
+    # 이벤트 루프에서 동시에 수정될 수 있으므로 잠금 안에서 복사
+    with digest_lock:
+        digest = json.loads(json.dumps(load_project_digest(project_id, user_id)))
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "dimension": dimension,
+        "count": exported,
+        "source_project_id": project_id,
+        "created_at": time.time(),
+        "digest": digest
+    }
+    with zipfile.ZipFile(snapshot_path, 'w', compression=zipfile.ZIP_STORED) as snapshot:
+        snapshot.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False))
+        snapshot.write(records_path, "records.jsonl")
+        snapshot.write(embeddings_path, "embeddings.npy")
+    return exported
+
+
+def import_collection_snapshot(
+    project_id: str,
+    user_id: Optional[str],
+    snapshot_path: str,
+    work_dir: str,
+    replace: bool = False
+) -> int:
+    """스냅샷을 컬렉션에 일괄 추가 (임베딩 재계산 없음), 가져온 청크 수 반환
+
+    같은 컬렉션에 원본과 복제본이 함께 있을 수 있으므로 file_id와 청크 ID는 새로 발급합니다.
+    """
+    try:
+        with zipfile.ZipFile(snapshot_path) as snapshot:
+            manifest = json.loads(snapshot.read("manifest.json"))
+            snapshot.extract("records.jsonl", work_dir)
+            snapshot.extract("embeddings.npy", work_dir)
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"스냅샷 형식 오류: {str(e)}")
+
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        raise HTTPException(status_code=400, detail=f"지원하지 않는 스냅샷 버전: {manifest.get('format_version')}")
+    if manifest.get("embedding_model") != EMBEDDING_MODEL_NAME:
+        raise HTTPException(
+            status_code=400,
+            detail=f"임베딩 모델 불일치: {manifest.get('embedding_model')} (현재: {EMBEDDING_MODEL_NAME})"
+        )
+
+    # 기존 데이터를 지우기 전에 스냅샷 내용이 manifest와 일치하는지 확인
+    embeddings_path = os.path.join(work_dir, "embeddings.npy")
+    records_path = os.path.join(work_dir, "records.jsonl")
+    count = manifest.get("count")
+    try:
+        embeddings = np.load(embeddings_path, mmap_mode='r') if count else np.load(embeddings_path)
+        with open(records_path, 'r', encoding='utf-8') as records_file:
+            records_count = 0
+            for line in records_file:
+                record = json.loads(line)
+                if not isinstance(record, dict) or not {"id", "document", "metadata"} <= record.keys():
+                    raise ValueError(f"레코드 필드 누락 ({records_count + 1}번째 줄)")
+                if not isinstance(record["id"], str) or not record["id"]:
+                    raise ValueError(f"잘못된 id ({records_count + 1}번째 줄)")
+                if not isinstance(record["document"], str):
+                    raise ValueError(f"잘못된 document: {record['id']}")
+                if not isinstance(record["metadata"], dict):
+                    raise ValueError(f"잘못된 metadata: {record['id']}")
+                records_count += 1
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"스냅샷 형식 오류: {str(e)}")
+    if records_count != count:
+        raise HTTPException(status_code=400, detail=f"레코드 수 불일치: {records_count} (manifest: {count})")
+    if count and embeddings.shape != (count, manifest.get("dimension")):
+        raise HTTPException(
+            status_code=400,
+            detail=f"임베딩 크기 불일치: {embeddings.shape} (manifest: {(count, manifest.get('dimension'))})"
+        )
+
+    if replace:
+        if COLLECTION_LAYOUT == "shared":
+            get_or_create_collection(project_id, user_id).delete()
+        else:
+            try:
+                chroma_client.delete_collection(name=legacy_collection_name(project_id, user_id))
+            except Exception:
+                pass
+        delete_project_digest_file(digest_path(project_id, user_id))
+    collection = get_or_create_collection(project_id, user_id)
+
+    file_ids: Dict[str, str] = {}
+    imported = 0
+    with open(records_path, 'r', encoding='utf-8') as records_file:
+        ids, documents, metadatas = [], [], []
+        for line in records_file:
+            record = json.loads(line)
+            metadata = record["metadata"]
+            old_file_id = metadata.get("file_id") or record["id"].rsplit("_chunk_", 1)[0]
+            new_file_id = file_ids.setdefault(old_file_id, str(uuid.uuid4()))
+            chunk_suffix = record["id"].rsplit("_chunk_", 1)[1] if "_chunk_" in record["id"] else str(imported + len(ids))
+            ids.append(f"{new_file_id}_chunk_{chunk_suffix}")
+            documents.append(record["document"])
+            metadatas.append({**metadata, "file_id": new_file_id})
+
+            if len(ids) == SNAPSHOT_BATCH_SIZE:
+                collection.add(
+                    ids=ids,
+                    documents=documents,
+                    embeddings=embeddings[imported:imported + len(ids)].tolist(),
+                    metadatas=metadatas
+                )
+                imported += len(ids)
+                ids, documents, metadatas = [], [], []
+        if ids:
+            collection.add(
+                ids=ids,
+                documents=documents,
+                embeddings=embeddings[imported:imported + len(ids)].tolist(),
+                metadatas=metadatas
+            )
+            imported += len(ids)
+    del embeddings
+
+    # 매뉴얼 요약도 새 file_id 기준으로 복사
+    source_digest = manifest.get("digest") or {}
+    for old_file_id, entry in source_digest.get("files", {}).items():
+        if old_file_id in file_ids:
+            update_file_digest(project_id, user_id, file_ids[old_file_id], entry["file_name"], entry["digest"])
+    return imported
+
+
+@app.get("/api/ai/project/{project_id}/snapshot")
+async def export_snapshot(project_id: str, user_id: Optional[str] = None):
+    """프로젝트 벡터 스냅샷 내보내기"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        snapshot_path = os.path.join(work_dir, "snapshot.zip")
+        count = await asyncio.to_thread(export_collection_snapshot, project_id, user_id, snapshot_path, work_dir)
+        print(f"[SNAPSHOT] Exported project_id: {project_id}, user_id: {user_id}, chunks: {count}")
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise HTTPException(status_code=500, detail=f"스냅샷 내보내기 오류: {str(e)}")
+
+    return FileResponse(
+        snapshot_path,
+        media_type="application/zip",
+        filename=f"snapshot_{scope_key(project_id)}.zip",
+        background=BackgroundTask(shutil.rmtree, work_dir, ignore_errors=True)
+    )
+
+
+@app.post("/api/ai/project/{project_id}/snapshot")
+async def import_snapshot(
+    project_id: str,
+    file: UploadFile = File(...),
+    user_id: Optional[str] = Form(None),
+    replace: bool = Form(False)  # True면 기존 임베딩을 지우고 가져오기
+):
+    """프로젝트 벡터 스냅샷 가져오기 (템플릿 프로젝트 복제, 노드 간 이동)"""
+    work_dir = tempfile.mkdtemp()
+    try:
+        snapshot_path = os.path.join(work_dir, "snapshot.zip")
+        with open(snapshot_path, 'wb') as f:
+            shutil.copyfileobj(file.file, f)
+        count = await asyncio.to_thread(
+            import_collection_snapshot, project_id, user_id, snapshot_path, work_dir, replace
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"스냅샷 가져오기 오류: {str(e)}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"[SNAPSHOT] Imported project_id: {project_id}, user_id: {user_id}, chunks: {count}")
+    return {"success": True, "chunks_count": count, "message": f"스냅샷 가져오기 완료: {count}개 청크"}
+
+
 # ========================
 # 시뮬레이션 관련 엔드포인트
 # ========================
@@ -500,14 +1376,15 @@ async def delete_project_files(project_id: str):
 @app.post("/api/ai/scenario", response_model=ScenarioResponse)
 async def generate_scenario(request: ScenarioRequest):
     """고객 시나리오 생성"""
-    # 프로젝트의 매뉴얼 컨텍스트 가져오기
-    try:
-        collection = get_or_create_collection(request.project_id, request.user_id)
-        # 임의의 컨텍스트 가져오기
-        results = collection.get(limit=5)
-        context = " ".join(results.get('documents', [])[:3]) if results.get('documents') else ""
-    except:
-        context = ""
+    # 프로젝트의 매뉴얼 요약 가져오기 (없으면 임의의 컨텍스트)
+    context = get_project_digest_text(request.project_id, request.user_id)
+    if not context:
+        try:
+            collection = get_or_create_collection(request.project_id, request.user_id)
+            results = collection.get(limit=5)
+            context = " ".join(results.get('documents', [])[:3]) if results.get('documents') else ""
+        except:
+            context = ""
 
     # 지침 추가
     guidelines = request.guidelines or ""
@@ -574,42 +1451,27 @@ async def chat(request: ChatRequest):
         collection = get_or_create_collection(request.project_id, request.user_id)
         query_embedding = embedding_model.encode(request.message).tolist()
         
-        # 컬렉션의 모든 문서 가져오기 (최대 20개)
-        doc_count = collection.count()
-        print(f"[CHAT] Collection doc_count: {doc_count}")
-        
-        if doc_count > 0:
-            n_results = min(20, doc_count)
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=n_results
-            )
-            seen = set()
-            for doc in results.get('documents', [[]])[0]:
-                doc_hash = hash(doc[:100])
-                if doc_hash not in seen:
-                    seen.add(doc_hash)
-                    unique_docs.append(doc)
+        # 컬렉션의 관련 문서 가져오기 (최대 20개)
+        results = query_collection(collection, [query_embedding], 20)
+        seen = set()
+        for doc in results.get('documents', [[]])[0]:
+            doc_hash = hash(doc[:100])
+            if doc_hash not in seen:
+                seen.add(doc_hash)
+                unique_docs.append(doc)
         
         # Fallback: 문서가 없으면 user_id 없이 검색 (비회원 시절 데이터)
         if not unique_docs and request.user_id:
             print(f"[CHAT] No docs found, trying fallback without user_id")
             try:
                 fallback_collection = get_or_create_collection(request.project_id, None)
-                fallback_count = fallback_collection.count()
-                print(f"[CHAT] Fallback collection doc_count: {fallback_count}")
-                if fallback_count > 0:
-                    n_results = min(20, fallback_count)
-                    results = fallback_collection.query(
-                        query_embeddings=[query_embedding],
-                        n_results=n_results
-                    )
-                    seen = set()
-                    for doc in results.get('documents', [[]])[0]:
-                        doc_hash = hash(doc[:100])
-                        if doc_hash not in seen:
-                            seen.add(doc_hash)
-                            unique_docs.append(doc)
+                results = query_collection(fallback_collection, [query_embedding], 20)
+                seen = set()
+                for doc in results.get('documents', [[]])[0]:
+                    doc_hash = hash(doc[:100])
+                    if doc_hash not in seen:
+                        seen.add(doc_hash)
+                        unique_docs.append(doc)
             except Exception as fallback_error:
                 print(f"[CHAT] Fallback error: {fallback_error}")
         
@@ -618,20 +1480,13 @@ async def chat(request: ChatRequest):
             print(f"[CHAT] No docs found, trying fallback to project_undefined")
             try:
                 fallback_collection = get_or_create_collection("undefined", None)
-                fallback_count = fallback_collection.count()
-                print(f"[CHAT] Fallback undefined collection doc_count: {fallback_count}")
-                if fallback_count > 0:
-                    n_results = min(20, fallback_count)
-                    results = fallback_collection.query(
-                        query_embeddings=[query_embedding],
-                        n_results=n_results
-                    )
-                    seen = set()
-                    for doc in results.get('documents', [[]])[0]:
-                        doc_hash = hash(doc[:100])
-                        if doc_hash not in seen:
-                            seen.add(doc_hash)
-                            unique_docs.append(doc)
+                results = query_collection(fallback_collection, [query_embedding], 20)
+                seen = set()
+                for doc in results.get('documents', [[]])[0]:
+                    doc_hash = hash(doc[:100])
+                    if doc_hash not in seen:
+                        seen.add(doc_hash)
+                        unique_docs.append(doc)
             except Exception as fallback_error:
                 print(f"[CHAT] Fallback error: {fallback_error}")
         
@@ -647,15 +1502,13 @@ async def chat(request: ChatRequest):
     guidelines = request.guidelines or ""
     guidelines_text = f"\n\n[프로젝트 지침]\n{guidelines}" if guidelines else ""
 
-    # 대화 히스토리 포맷팅
-    history_text = ""
-    if request.conversation_history:
-        history_lines = []
-        for msg in request.conversation_history[-10:]:  # 최근 10개 메시지만
-            role_label = "고객" if msg.get("role") == "user" else "직원"
-            history_lines.append(f"{role_label}: {msg.get('content', '')}")
-        if history_lines:
-            history_text = f"\n\n[이전 대화 내용]\n" + "\n".join(history_lines)
+    # 대화 히스토리 포맷팅 (이전 대화 요약 + 토큰 예산 내 최근 대화)
+    conversation_state = get_conversation_state(
+        (request.user_id or "", request.project_id, request.conversation_id),
+        request.role,
+        request.conversation_history
+    )
+    history_text = build_history_text(conversation_state)
 
     llm_config = get_llm_config_from_model_id(request.model_id, request.api_keys)
 
@@ -681,15 +1534,19 @@ async def chat(request: ChatRequest):
 친절한 답변:"""
 
         response = await call_llm(prompt, llm_config)
+        finish_conversation_turn(conversation_state, request, response, llm_config)
         return ChatResponse(response=response)
 
     else:
         # 사용자가 직원 역할 -> AI가 고객 역할 + 평가
+        # 매뉴얼 요약은 공통 접두부로, 그 뒤에 관련도 상위 검색 결과만 짧게 사용
+        # (요약 + 발췌가 기존 매뉴얼 발췌 길이를 넘지 않도록)
+        manual_prefix = digest_prefix(get_project_digest_text(request.project_id, request.user_id))
         # 1. 평가
-        eval_prompt = f"""다음 업무 매뉴얼과 지침을 기준으로 직원의 고객 응답을 평가해주세요:
+        eval_prompt = f"""{manual_prefix}다음 업무 매뉴얼과 지침을 기준으로 직원의 고객 응답을 평가해주세요:
 
 업무 매뉴얼:
-{context[:1000]}{guidelines_text}{history_text}
+{manual_excerpt(unique_docs, manual_prefix, 1000)}{guidelines_text}{history_text}
 
 직원 응답: {request.message}
 
@@ -708,14 +1565,11 @@ async def chat(request: ChatRequest):
 
         eval_content = await call_llm(eval_prompt, llm_config)
         
-        # 점수 추출
-        total_score = 12
-        try:
-            if '총점:' in eval_content:
-                score_line = [line for line in eval_content.split('\n') if '총점:' in line][0]
-                total_score = int(score_line.split('/')[0].split(':')[-1].strip())
-        except:
-            pass
+        # 점수 추출 (추출 실패 시 기본값 12)
+        total_score = parse_evaluation_scores(eval_content)["total"]
+        if total_score is None:
+            print(f"[CHAT] Failed to parse evaluation score: {eval_content[:100]}...")
+            total_score = 12
 
         evaluation = {
             'score': total_score,
@@ -724,10 +1578,10 @@ async def chat(request: ChatRequest):
         }
 
         # 2. 다음 고객 응답 생성
-        customer_prompt = f"""당신은 서비스를 이용하는 고객입니다.
+        customer_prompt = f"""{manual_prefix}당신은 서비스를 이용하는 고객입니다.
 
 [업무/서비스 매뉴얼 발췌]
-{context[:800]}{guidelines_text}{history_text}
+{manual_excerpt(unique_docs, manual_prefix, 800)}{guidelines_text}{history_text}
 
 위 매뉴얼의 주제와 용어를 벗어나지 말고,
 이전 대화 맥락을 고려하여 직원의 답변을 들은 뒤 이어질 다음 고객 질문/반응을 한 문장으로만 작성하세요.
@@ -737,10 +1591,132 @@ async def chat(request: ChatRequest):
 고객 답변 (50자 이내, 한 문장):"""
 
         customer_response = await call_llm(customer_prompt, llm_config)
-        
+        finish_conversation_turn(conversation_state, request, customer_response, llm_config)
+
         return ChatResponse(response=customer_response, evaluation=evaluation)
 
 
+# ========================
+# 일괄 평가
+# ========================
+
+def get_project_context(project_id: str, user_id: Optional[str] = None) -> List[str]:
+    """평가용 프로젝트 매뉴얼 문서 (회원 컬렉션이 비어 있으면 비회원 컬렉션 사용)"""
+    for owner in ([user_id, None] if user_id else [None]):
+        try:
+            collection = get_or_create_collection(project_id, owner)
+            results = collection.get(limit=5)
+            documents = results.get('documents') or []
+            if documents:
+                return documents[:3]
+        except Exception as e:
+            print(f"[BATCH] Context error: {e}")
+    return []
+
+
+async def evaluate_transcript(
+    index: int,
+    item: BatchEvaluationItem,
+    manual_prefix: str,
+    documents: List[str],
+    llm_config: LLMConfigRequest
+) -> Dict[str, Any]:
+    """대화 기록 1건 평가"""
+    guidelines_text = f"\n\n[프로젝트 지침]\n{item.guidelines}" if item.guidelines else ""
+    transcript_text = "\n".join(format_history_lines(item.transcript, item.role))
+
+    eval_prompt = f"""{manual_prefix}다음 업무 매뉴얼과 지침을 기준으로 아래 상담 대화에서 직원의 고객 응대를 평가해주세요:
+
+업무 매뉴얼:
+{manual_excerpt(documents, manual_prefix, 1000)}{guidelines_text}
+
+[상담 대화]
+{transcript_text}
+
+다음 기준으로 평가해주세요:
+1. 정확성 (1-5점)
+2. 친절성 (1-5점)
+3. 적절성 (1-5점)
+총점: /15점
+
+형식:
+정확성: X/5 - 간단한 코멘트
+친절성: X/5 - 간단한 코멘트
+적절성: X/5 - 간단한 코멘트
+총점: X/15
+개선점: 구체적인 개선 제안"""
+
+    result: Dict[str, Any] = {
+        "index": index,
+        "item_id": item.item_id,
+        "project_id": item.project_id,
+    }
+    semaphore = batch_semaphores.setdefault(
+        llm_config.provider,
+        asyncio.Semaphore(BATCH_PROVIDER_CONCURRENCY.get(llm_config.provider, 4))
+    )
+    try:
+        async with semaphore:
+            eval_content = await call_llm(eval_prompt, llm_config)
+    except HTTPException as e:
+        result["error"] = e.detail
+        return result
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+
+    scores = parse_evaluation_scores(eval_content)
+    result.update({
+        "score": scores.pop("total"),
+        "max_score": 15,
+        "criteria": scores,
+        "feedback": eval_content
+    })
+    return result
+
+
+@app.post("/api/ai/evaluate/batch")
+async def evaluate_batch(request: BatchEvaluationRequest):
+    """여러 대화 기록 일괄 평가 - 완료되는 순서대로 NDJSON 스트리밍"""
+    print(f"[BATCH] items: {len(request.items)}, model_id: {request.model_id}")
+    llm_config = get_llm_config_from_model_id(request.model_id, request.api_keys)
+
+    # 매뉴얼 컨텍스트는 프로젝트당 한 번만, 필요할 때 별도 스레드에서 조회 (이벤트 루프 블로킹 방지)
+    context_tasks: Dict[tuple, asyncio.Task] = {}
+
+    def load_context(project_id: str, user_id: Optional[str]) -> tuple:
+        return (
+            digest_prefix(get_project_digest_text(project_id, user_id)),
+            get_project_context(project_id, user_id)
+        )
+
+    async def evaluate_item(index: int, item: BatchEvaluationItem) -> Dict[str, Any]:
+        key = (item.project_id, item.user_id)
+        if key not in context_tasks:
+            context_tasks[key] = asyncio.create_task(asyncio.to_thread(load_context, *key))
+        try:
+            manual_prefix, documents = await context_tasks[key]
+        except Exception as e:
+            return {"index": index, "item_id": item.item_id, "project_id": item.project_id, "error": str(e)}
+        return await evaluate_transcript(index, item, manual_prefix, documents, llm_config)
+
+    async def stream_results():
+        tasks = [
+            asyncio.create_task(evaluate_item(i, item))
+            for i, item in enumerate(request.items)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # 클라이언트 연결이 끊기면 남은 평가 취소
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 # ========================
 # 헬스체크
 # ========================
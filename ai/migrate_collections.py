@@ -0,0 +1,157 @@
+"""
+컬렉션 구성 방식 마이그레이션 도구
+per_user 방식(사용자×프로젝트별 컬렉션)의 데이터를 shared 방식(프로젝트별 공유 컬렉션)으로 복사
+
+임베딩을 다시 계산하지 않고 저장된 벡터를 그대로 옮깁니다.
+
+컬렉션 메타데이터에 기록된 project_id/user_id를 우선 사용하고, 없으면 컬렉션 이름에서 추출합니다.
+메타데이터가 없고 이름이 해시로 축약된 컬렉션(회원 컬렉션 대부분)은 ID 목록을 지정해야 합니다.
+
+사용 예:
+    # 메타데이터 또는 이름에서 ID를 알 수 있는 컬렉션 자동 마이그레이션
+    python migrate_collections.py
+
+    # ID 목록 파일 지정 (한 줄에 PROJECT_ID 또는 PROJECT_ID:USER_ID, 백엔드 DB에서 추출)
+    python migrate_collections.py --pairs-file pairs.txt
+
+    # 개별 지정
+    python migrate_collections.py --pair 1234:abcd --pair 5678
+
+    # 복사 후 원본 컬렉션 삭제
+    python migrate_collections.py --delete-source
+
+shared 방식 서버와 같은 COLLECTION_SHARDS 값으로 실행해야 합니다.
+"""
+
+import argparse
+import re
+from typing import List, Optional, Tuple
+
+from main import (
+    chroma_client,
+    legacy_collection_name,
+    shared_collection_name,
+    ScopedCollection,
+)
+
+USER_COLLECTION_PATTERN = re.compile(r"^user_(.+)_project_(.+)$")
+PROJECT_COLLECTION_PATTERN = re.compile(r"^project_(.+)$")
+
+
+def list_collection_names() -> List[str]:
+    # ChromaDB 버전에 따라 이름 또는 Collection 객체 목록을 반환
+    return [getattr(c, "name", c) for c in chroma_client.list_collections()]
+
+
+def read_collection_owner(name: str) -> Optional[Tuple[str, Optional[str]]]:
+    """컬렉션 메타데이터에 기록된 (project_id, user_id), 없으면 None"""
+    metadata = chroma_client.get_collection(name=name).metadata or {}
+    if metadata.get("project_id"):
+        return metadata["project_id"], metadata.get("user_id") or None
+    return None
+
+
+def read_pairs_file(path: str) -> List[str]:
+    """ID 목록 파일 읽기 (빈 줄과 # 주석 무시)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+
+
+def parse_collection_name(name: str) -> Optional[Tuple[str, Optional[str]]]:
+    """per_user 컬렉션 이름에서 (project_id, user_id) 추출, 해시로 축약된 이름이면 None"""
+    if len(name) == 63 and re.search(r"_[0-9a-f]{8}$", name):
+        return None
+    match = USER_COLLECTION_PATTERN.match(name)
+    if match:
+        return match.group(2), match.group(1)
+    match = PROJECT_COLLECTION_PATTERN.match(name)
+    if match:
+        return match.group(1), None
+    return None
+
+
+def migrate_collection(source_name: str, project_id: str, user_id: Optional[str], batch_size: int) -> int:
+    """컬렉션 1개를 공유 컬렉션으로 복사, 복사한 청크 수 반환"""
+    source = chroma_client.get_collection(name=source_name)
+    target = ScopedCollection(
+        chroma_client.get_or_create_collection(name=shared_collection_name(project_id)),
+        project_id,
+        user_id
+    )
+
+    copied = 0
+    while True:
+        batch = source.get(
+            limit=batch_size,
+            offset=copied,
+            include=["documents", "metadatas", "embeddings"]
+        )
+        ids = batch["ids"]
+        if not ids:
+            break
+        embeddings = batch["embeddings"]
+        target.upsert(
+            ids=ids,
+            documents=batch["documents"],
+            embeddings=embeddings.tolist() if hasattr(embeddings, "tolist") else embeddings,
+            metadatas=batch["metadatas"]
+        )
+        copied += len(ids)
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per_user 컬렉션을 shared 컬렉션으로 마이그레이션")
+    parser.add_argument("--pair", action="append", default=[],
+                        help="PROJECT_ID 또는 PROJECT_ID:USER_ID (해시로 축약된 컬렉션용)")
+    parser.add_argument("--pairs-file",
+                        help="한 줄에 PROJECT_ID 또는 PROJECT_ID:USER_ID가 있는 파일 (--pair 대량 지정)")
+    parser.add_argument("--delete-source", action="store_true", help="복사 후 원본 컬렉션 삭제")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    existing = set(list_collection_names())
+    targets = {}
+    unresolved = set()
+
+    for name in existing:
+        if name.startswith("shared_"):
+            continue
+        parsed = read_collection_owner(name) or parse_collection_name(name)
+        if parsed:
+            targets[name] = parsed
+        else:
+            unresolved.add(name)
+
+    pairs = list(args.pair)
+    if args.pairs_file:
+        pairs.extend(read_pairs_file(args.pairs_file))
+    missing = 0
+    for pair in pairs:
+        project_id, _, user_id = pair.partition(":")
+        name = legacy_collection_name(project_id, user_id or None)
+        if name in existing:
+            targets[name] = (project_id, user_id or None)
+            unresolved.discard(name)
+        else:
+            missing += 1
+    if missing:
+        print(f"[MIGRATE] 지정한 ID 중 컬렉션이 없는 항목: {missing}개")
+
+    total = 0
+    for name, (project_id, user_id) in sorted(targets.items()):
+        copied = migrate_collection(name, project_id, user_id, args.batch_size)
+        total += copied
+        print(f"[MIGRATE] {name} -> {shared_collection_name(project_id)}: {copied}개 청크")
+        if args.delete_source:
+            chroma_client.delete_collection(name=name)
+
+    print(f"[MIGRATE] 완료: 컬렉션 {len(targets)}개, 청크 {total}개")
+    if unresolved:
+        print("[MIGRATE] ID를 알 수 없어 건너뛴 컬렉션 (--pair 또는 --pairs-file로 지정 필요):")
+        for name in sorted(unresolved):
+            print(f"  {name}")
+
+
+if __name__ == "__main__":
+    main()